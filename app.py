@@ -1,16 +1,88 @@
 import asyncio
-import json
 import logging
 import os
+import re
 import sys
+import time
 import html as _html
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 
-from telethon import TelegramClient, errors, events
+import orjson
+from telethon import TelegramClient, errors, events, helpers, utils
+from telethon.sessions import SQLiteSession, StringSession
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+
+# Telegram limits: ~30 messages/s per account and ~1 message/s per chat
+GLOBAL_RATE = 30.0
+PER_CHAT_RATE = 1.0
+
+# username -> id resolutions are cached on disk; failures are only remembered briefly
+RESOLVE_CACHE_TTL = 24 * 3600
+RESOLVE_NEGATIVE_TTL = 20
+# concurrent get_entity calls on a cold start, kept low to stay clear of FLOOD_WAIT
+RESOLVE_CONCURRENCY = 5
+
+
+class TokenBucket:
+	"""Simple asyncio token bucket: `rate` tokens per second, up to `capacity`."""
+
+	__slots__ = ("rate", "capacity", "tokens", "last", "_lock")
+
+	def __init__(self, rate: float, capacity: Optional[float] = None):
+		self.rate = float(rate)
+		self.capacity = float(capacity if capacity is not None else rate)
+		self.tokens = self.capacity
+		self.last = time.monotonic()
+		# created on first acquire(): before Python 3.10, asyncio primitives bind to the
+		# loop that is current at construction, and buckets may be built before asyncio.run()
+		self._lock: Optional[asyncio.Lock] = None
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	async def acquire(self):
+		# The lock makes concurrent senders queue up instead of all waking at once
+		if self._lock is None:
+			self._lock = asyncio.Lock()
+		async with self._lock:
+			self._refill()
+			if self.tokens < 1:
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+				self._refill()
+			self.tokens -= 1
 
 
 class MirrorBot:
 
+	# fixed attribute layout: no per-instance __dict__ lookups on the message path
+	__slots__ = (
+		"api_id",
+		"api_hash",
+		"session_name",
+		"raw_mappings",
+		"mappings",
+		"delay",
+		"_global_bucket",
+		"_chat_buckets",
+		"_flood_until",
+		"enable_logs",
+		"keywords",
+		"_kw_re",
+		"log",
+		"_info",
+		"_handler",
+		"_resolve_cache_path",
+		"_resolve_cache",
+		"_negative_ts",
+		"_peer_cache",
+		"_resolve_sem",
+		"_session_str_path",
+		"client",
+	)
+
 	def __init__(
 		self,
 		api_id: int,
@@ -26,11 +98,19 @@ class MirrorBot:
 		self.session_name = session_name
 		# raw_mappings: { source: [dest, ...], ... } accept ints or strings
 		self.raw_mappings = raw_mappings or {}
-		# resolved mapping will be filled after client start: { int_source_id: [int_dest_id, ...] }
-		self.mappings: Dict[int, List[int]] = {}
+		# resolved mapping will be filled after client start: { int_source_id: (dest_input_peer, ...) }
+		self.mappings: Dict[int, Tuple[Any, ...]] = {}
+		# kept for config compatibility; sends are throttled by the token buckets below
 		self.delay = float(delay)
+		self._global_bucket = TokenBucket(GLOBAL_RATE)
+		self._chat_buckets: Dict[Any, TokenBucket] = {}
+		# monotonic time until which Telegram asked us to stop sending (FloodWait)
+		self._flood_until = 0.0
 		self.enable_logs = enable_logs
-		self.keywords = [k.lower() for k in keywords] if keywords else []
+		# empty keywords would match everything anyway, so they are dropped here
+		self.keywords = [k.lower() for k in keywords if k] if keywords else []
+		# all keywords compiled into one pattern so each message is scanned once
+		self._kw_re = re.compile("|".join(re.escape(k) for k in self.keywords), re.IGNORECASE) if self.keywords else None
 
 		if enable_logs:
 			logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
@@ -38,30 +118,75 @@ class MirrorBot:
 			logging.basicConfig(level=logging.WARNING, format="[%(asctime)s] %(levelname)s: %(message)s")
 
 		self.log = logging.getLogger("MirrorBot")
-
-		# Create the client; session file will be created like '<session_name>.session'
-		self.client = TelegramClient(self.session_name, self.api_id, self.api_hash)
+		# checked once so hot paths can skip building log records entirely
+		self._info = self.log.isEnabledFor(logging.INFO)
+		self._handler = None
+
+		# On-disk cache of username resolutions:
+		# { username: {"id": marked_peer_id, "type": str, "access_hash": int|None, "ts": float} }
+		self._resolve_cache_path = f"{session_name}.resolve.json"
+		self._resolve_cache: Dict[str, Dict[str, Any]] = {}
+		self._negative_ts: Dict[str, float] = {}
+		# The in-memory session forgets access hashes on restart, so the peers we send to
+		# are cached too: { str(marked_peer_id): {"type": str, "access_hash": int|None} }
+		self._peer_cache: Dict[str, Dict[str, Any]] = {}
+		# created in start(), inside the running loop (required before Python 3.10)
+		self._resolve_sem: Optional[asyncio.Semaphore] = None
+		self._load_resolve_cache()
+
+		# The auth key is kept in '<session_name>.session.str'; at runtime the client uses an
+		# in-memory session, so the entity cache is never written to SQLite on the send path.
+		self._session_str_path = f"{session_name}.session.str"
+		self.client = TelegramClient(StringSession(self._load_session_string()), self.api_id, self.api_hash)
 
 	async def start(self):
 		"""Start the Telegram client and register handlers."""
 		while True:
 			try:
 				await self.client.start()
+				self._save_session_string()
 				self.log.info("Client started. Listening for mappings: %s", list(self.raw_mappings.keys()))
 
 				# Resolve any username keys to numeric ids and build final mapping
+				self._resolve_sem = asyncio.Semaphore(RESOLVE_CONCURRENCY)
 				await self._resolve_mappings()
 
 				listen_chats = list(self.mappings.keys())
-				self.log.info("Resolved mappings: %s", self.mappings)
+				if self._info:
+					# mappings hold InputPeers; log their marked ids instead of object reprs
+					self.log.info(
+						"Resolved mappings: %s",
+						{src: [utils.get_peer_id(d) for d in dests] for src, dests in self.mappings.items()},
+					)
 				if not listen_chats:
 					self.log.warning("No source chats resolved — check mappings in config.json. Reconnecting in 5s.")
 					await asyncio.sleep(5)
 					continue
 
-				@self.client.on(events.NewMessage(chats=listen_chats))
+				# bound once per registration; self.mappings is only replaced on reconnect
+				mappings_get = self.mappings.get
+				me_id = (await self.client.get_me()).id
+				# chats accepted by the filter but missing from mappings; warned once each
+				unmapped = set()
+
+				# drop the handler from a previous iteration so messages aren't mirrored twice
+				if self._handler is not None:
+					self.client.remove_event_handler(self._handler)
+
+				# incoming=True lets Telethon drop our own (outgoing) messages before they reach Python
+				@self.client.on(events.NewMessage(chats=listen_chats, incoming=True))
 				async def handler(event: events.NewMessage.Event):
-					await self._on_message(event)
+					# cheapest check first: drop chats without destinations before touching the message
+					dests = mappings_get(event.chat_id)
+					if not dests:
+						if event.chat_id not in unmapped:
+							unmapped.add(event.chat_id)
+							self.log.warning("No destination configured for source %s", event.chat_id)
+						return
+					if event.message.via_bot_id != me_id:
+						await self._on_message(event, dests)
+
+				self._handler = handler
 
 				# Run until disconnected; Telethon handles reconnections internally,
 				# but we wrap start() in an outer loop to recover from unexpected errors.
@@ -78,121 +203,328 @@ class MirrorBot:
 				self.log.exception("Unexpected error, reconnecting in 5 seconds: %s", exc)
 				await asyncio.sleep(5)
 
-	async def _on_message(self, event: events.NewMessage.Event):
+	async def _on_message(self, event: events.NewMessage.Event, dests: Tuple[Any, ...]):
 		msg = event.message
 
 		# Ignore service messages and empty messages
 		if getattr(msg, "action", None) is not None:
 			return
-		if (not msg.message or msg.message.strip() == "") and not msg.media:
-			return
-
 		text = msg.message or ""
+		media = msg.media
+		if not media and (not text or text.isspace()):
+			return
 
 		# Keyword filter (if provided)
-		if self.keywords:
-			lower_text = text.lower()
-			if not any(k in lower_text for k in self.keywords):
+		kw_re = self._kw_re
+		if kw_re is not None and not kw_re.search(text):
+			if self._info:
 				self.log.info("Skipping message (no keyword match)")
-				return
+			return
 
 		# Prepare sending
 		try:
 			src_id = event.chat_id
-			dests = self.mappings.get(src_id, [])
-			if not dests:
-				self.log.warning("No destination configured for source %s", src_id)
-				return
 
-			for dest in dests:
+			# Look up entities and render HTML once, not per destination.
+			# Media captions are sent with the entities as they are, so only text messages need HTML.
+			entities = getattr(msg, "entities", None) or None
+			html_text = None
+			if entities and not media:
 				try:
-					if msg.media:
-						await self.client.send_file(
-							dest,
-							msg.media,
-							caption=text or None,
-							caption_entities=msg.entities if getattr(msg, "entities", None) else None,
-						)
-					else:
-						# For text-only messages, convert Telegram entities to HTML and send with parse_mode
-						if getattr(msg, "entities", None):
-							try:
-								html_text = entities_to_html(text, msg.entities)
-								await self.client.send_message(dest, html_text, parse_mode="html")
-							except Exception:
-								# fallback to plain text if conversion fails
-								await self.client.send_message(dest, text)
-						else:
-							await self.client.send_message(dest, text)
-
-					self.log.info("Mirrored message from %s to %s", src_id, dest)
-
-					if self.delay and self.delay > 0:
-						await asyncio.sleep(self.delay)
-
-				except errors.FloodWaitError as fw_inner:
-					wait = fw_inner.seconds if hasattr(fw_inner, "seconds") else 60
-					self.log.warning("Hit FloodWait when sending to %s: sleeping %s seconds", dest, wait)
-					await asyncio.sleep(wait + 5)
-				except errors.rpcerrorlist.ChatWriteForbiddenError:
-					self.log.error("Permission denied: can't send messages to destination %s", dest)
-				except Exception as e_inner:
-					self.log.exception("Failed to mirror to %s: %s", dest, e_inner)
+					html_text = entities_to_html(text, entities)
+				except Exception:
+					# fallback to plain text if conversion fails
+					self.log.warning("Failed to convert entities to HTML; sending plain text")
+
+			# Fan out to all destinations concurrently; errors are handled per destination
+			send_to = self._send_to
+			results = await asyncio.gather(
+				*(send_to(dest, msg, text, entities, html_text, src_id) for dest in dests),
+				return_exceptions=True,
+			)
+			# _send_to logs its own send errors; anything here escaped its try block
+			for dest, result in zip(dests, results):
+				if isinstance(result, BaseException):
+					self.log.error("Failed to mirror to %s: %r", dest, result)
 
 		except Exception as e:
 			self.log.exception("Failed to mirror message: %s", e)
 
+	async def _send_to(self, dest, msg, text: str, entities, html_text: Optional[str], src_id: int):
+		"""Mirror a single message to one destination."""
+		# InputPeer objects aren't hashable, so buckets are keyed by the marked peer id
+		dest_id = utils.get_peer_id(dest)
+		bucket = self._chat_buckets.get(dest_id)
+		if bucket is None:
+			bucket = self._chat_buckets[dest_id] = TokenBucket(PER_CHAT_RATE)
+
+		try:
+			# A FloodWait seen by any sender pauses all of them, so we don't earn a longer one.
+			# If one starts while we queue for tokens, those tokens are stale: wait it out and
+			# queue again, so senders resume at the bucket rate instead of all at once.
+			while True:
+				wait = self._flood_until - time.monotonic()
+				if wait > 0:
+					await asyncio.sleep(wait)
+				# per-chat first: the global token is only taken right before the RPC,
+				# so senders waiting on a slow chat don't sit on global capacity
+				await bucket.acquire()
+				await self._global_bucket.acquire()
+				if time.monotonic() >= self._flood_until:
+					break
+
+			client = self.client
+			media = msg.media
+			if media:
+				await client.send_file(
+					dest,
+					media,
+					caption=text or None,
+					# send_file has no caption_entities; without parse_mode=None the caption
+					# would be parsed as markdown when there are no entities
+					formatting_entities=entities,
+					parse_mode=None,
+				)
+			elif not html_text:
+				# plain text (the common case): no formatting, no fallback needed
+				await client.send_message(dest, text, parse_mode=None)
+			else:
+				# For formatted text-only messages, send the pre-rendered HTML
+				try:
+					await client.send_message(dest, html_text, parse_mode="html")
+				except Exception:
+					# fallback to plain text if the HTML is rejected
+					await client.send_message(dest, text, parse_mode=None)
+
+			self.log.debug("Mirrored message from %s to %s", src_id, dest_id)
+
+		except errors.FloodWaitError as fw_inner:
+			wait = fw_inner.seconds if hasattr(fw_inner, "seconds") else 60
+			self.log.warning("Hit FloodWait when sending to %s: pausing all sends for %s seconds", dest_id, wait)
+			self._flood_until = max(self._flood_until, time.monotonic() + wait + 5)
+		except errors.rpcerrorlist.ChatWriteForbiddenError:
+			self.log.error("Permission denied: can't send messages to destination %s", dest_id)
+		except Exception as e_inner:
+			self.log.exception("Failed to mirror to %s: %s", dest_id, e_inner)
+
+	def _load_resolve_cache(self):
+		"""Load cached username resolutions from disk, ignoring a missing or corrupt file."""
+		if not os.path.exists(self._resolve_cache_path):
+			return
+		try:
+			with open(self._resolve_cache_path, "rb") as f:
+				data = orjson.loads(f.read())
+			self._resolve_cache = data.get("resolved", {})
+			self._negative_ts = data.get("failed", {})
+			self._peer_cache = data.get("peers", {})
+		except Exception as e:
+			self.log.warning("Could not read resolve cache %s: %s", self._resolve_cache_path, e)
+
+	def _save_resolve_cache(self):
+		"""Atomically write the resolve cache next to the session file."""
+		tmp_path = self._resolve_cache_path + ".tmp"
+		try:
+			with open(tmp_path, "wb") as f:
+				f.write(orjson.dumps({
+					"resolved": self._resolve_cache,
+					"failed": self._negative_ts,
+					"peers": self._peer_cache,
+				}))
+			os.replace(tmp_path, self._resolve_cache_path)
+		except Exception as e:
+			self.log.warning("Could not write resolve cache %s: %s", self._resolve_cache_path, e)
+
+	async def _resolve_one(self, username: str):
+		"""Fetch a single entity from Telegram, returning None on failure."""
+		async with self._resolve_sem:
+			try:
+				return await asyncio.wait_for(self.client.get_entity(username), timeout=10)
+			except asyncio.TimeoutError:
+				self.log.warning("Timeout resolving %s", username)
+			except Exception as e:
+				self.log.warning("Failed to resolve %s: %s", username, e)
+			return None
+
+	async def _resolve_usernames(self, usernames: List[str]) -> Dict[str, int]:
+		"""Resolve usernames to numeric ids, using the on-disk cache when fresh.
+
+		Cache misses are fetched concurrently, at most RESOLVE_CONCURRENCY at a time.
+		Usernames that could not be resolved are missing from the result.
+		"""
+		now = time.time()
+		found: Dict[str, int] = {}
+		pending: List[str] = []
+
+		for username in usernames:
+			key = username.lower()
+			cached = self._resolve_cache.get(key)
+			# entries without a peer type predate access-hash caching and are re-resolved
+			if cached and "type" in cached and now - cached["ts"] < RESOLVE_CACHE_TTL:
+				if self._info:
+					self.log.info("Resolved %s -> %s (cached)", username, cached["id"])
+				self._peer_cache[str(cached["id"])] = {"type": cached["type"], "access_hash": cached["access_hash"]}
+				found[username] = cached["id"]
+				continue
+			failed_at = self._negative_ts.get(key)
+			if failed_at and now - failed_at < RESOLVE_NEGATIVE_TTL:
+				self.log.warning("Skipping %s: resolution failed recently", username)
+				continue
+			pending.append(username)
+
+		if not pending:
+			return found
+
+		# resolved individually so one bad username can't fail the others
+		ents = await asyncio.gather(*(self._resolve_one(u) for u in pending), return_exceptions=True)
+
+		for username, ent in zip(pending, ents):
+			key = username.lower()
+			if ent is None or isinstance(ent, BaseException):
+				self._negative_ts[key] = now
+				continue
+			# marked id (-100… for channels), the same format as event.chat_id
+			peer_id = utils.get_peer_id(ent)
+			info = _peer_info(utils.get_input_peer(ent))
+			self._negative_ts.pop(key, None)
+			# peers we can't rebuild offline (e.g. our own account) aren't cached
+			if info is not None:
+				self._resolve_cache[key] = {"id": peer_id, "ts": now, **info}
+				self._peer_cache[str(peer_id)] = info
+			found[username] = peer_id
+			if self._info:
+				self.log.info("Resolved %s -> %s", username, peer_id)
+
+		return found
+
+	def _load_session_string(self) -> str:
+		"""Return the saved session string, migrating a legacy SQLite session if present."""
+		if os.path.exists(self._session_str_path):
+			with open(self._session_str_path, "r", encoding="utf-8") as f:
+				return f.read().strip()
+		if os.path.exists(f"{self.session_name}.session"):
+			self.log.info("Migrating %s.session to an in-memory session", self.session_name)
+			legacy = SQLiteSession(self.session_name)
+			try:
+				return StringSession.save(legacy)
+			finally:
+				legacy.close()
+		# no session yet: client.start() will ask to log in
+		return ""
+
+	def _save_session_string(self):
+		"""Persist the auth key so the next start doesn't need to log in again."""
+		session_str = self.client.session.save()
+		if not session_str:
+			return
+		if os.path.exists(self._session_str_path):
+			with open(self._session_str_path, "r", encoding="utf-8") as f:
+				if f.read().strip() == session_str:
+					return
+		tmp_path = self._session_str_path + ".tmp"
+		# the session string grants full account access, keep it private
+		fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, "w", encoding="utf-8") as f:
+			f.write(session_str)
+		os.replace(tmp_path, self._session_str_path)
+
+	async def _input_peer(self, peer_id: int):
+		"""Return the InputPeer for a numeric id, or None if it isn't known yet."""
+		info = self._peer_cache.get(str(peer_id))
+		if info is not None:
+			return _build_input_peer(peer_id, info)
+		try:
+			peer = await self.client.get_input_entity(peer_id)
+		except Exception:
+			return None
+		info = _peer_info(peer)
+		if info is not None:
+			self._peer_cache[str(peer_id)] = info
+		return peer
+
 	async def _resolve_mappings(self):
 		"""Resolve mapping keys (usernames) to numeric ids when possible."""
-		resolved: Dict[int, List[int]] = {}
+		# normalize raw values and collect every username that needs resolving
+		normalized = []
+		usernames: Dict[str, None] = {}
 		for raw_src, raw_dests in self.raw_mappings.items():
-			# normalize raw values
 			try:
 				src_norm = normalize_id(raw_src)
 			except Exception:
 				src_norm = raw_src
+			dests_norm = [normalize_id(d) for d in raw_dests]
+			normalized.append((src_norm, dests_norm))
 
-			self.log.info("Resolving source: %s", src_norm)
+			# after normalize_id, any remaining string is a username
+			for v in [src_norm, *dests_norm]:
+				if isinstance(v, str):
+					usernames[v] = None
 
-			# resolve source to numeric id if needed
-			src_id = src_norm
-			if isinstance(src_norm, str) and not (src_norm.isdigit() or (src_norm.startswith("-") and src_norm[1:].isdigit())):
-				try:
-					ent = await asyncio.wait_for(self.client.get_entity(src_norm), timeout=10)
-					src_id = ent.id
-					self.log.info("Resolved source %s -> %s", src_norm, src_id)
-				except asyncio.TimeoutError:
-					self.log.warning("Timeout resolving source %s; skipping", src_norm)
-					continue
-				except Exception as e:
-					self.log.warning("Failed to resolve source %s: %s; skipping", src_norm, e)
-					continue
+		if self._info:
+			self.log.info("Resolving usernames: %s", list(usernames))
+		name_to_id = await self._resolve_usernames(list(usernames))
+
+		resolved: Dict[int, List[int]] = {}
+		for src_norm, dests_norm in normalized:
+			src_id = name_to_id.get(src_norm, src_norm) if isinstance(src_norm, str) else src_norm
+			try:
+				src_id = int(src_id)
+			except Exception:
+				self.log.warning("Could not resolve source %s; skipping", src_norm)
+				continue
 
 			dest_ids: List[int] = []
-			for d in raw_dests:
-				d_norm = normalize_id(d)
-				self.log.info("Resolving destination: %s for source %s", d_norm, src_norm)
-				if isinstance(d_norm, str) and not (d_norm.isdigit() or (d_norm.startswith("-") and d_norm[1:].isdigit())):
-					try:
-						ent = await asyncio.wait_for(self.client.get_entity(d_norm), timeout=10)
-						dest_ids.append(ent.id)
-						self.log.info("Resolved destination %s -> %s", d_norm, ent.id)
-					except asyncio.TimeoutError:
-						self.log.warning("Timeout resolving destination %s; skipping", d_norm)
-					except Exception as e:
-						self.log.warning("Failed to resolve destination %s: %s; skipping", d_norm, e)
-				else:
-					try:
-						dest_ids.append(int(d_norm))
-					except Exception:
-						self.log.warning("Invalid destination id %s; skipping", d_norm)
+			for d_norm in dests_norm:
+				dest_id = name_to_id.get(d_norm, d_norm) if isinstance(d_norm, str) else d_norm
+				try:
+					dest_ids.append(int(dest_id))
+				except Exception:
+					self.log.warning("Invalid or unresolved destination %s for source %s; skipping", d_norm, src_norm)
 
 			if dest_ids:
-				resolved[int(src_id)] = dest_ids
+				# a source may be listed more than once (e.g. by username and by id)
+				resolved.setdefault(src_id, []).extend(dest_ids)
 			else:
 				self.log.warning("No valid destinations found for source %s; skipping mapping", src_id)
 
-		self.mappings = resolved
+		# drop duplicate destinations so a message is never sent twice to the same chat
+		resolved = {src_id: list(dict.fromkeys(dest_ids)) for src_id, dest_ids in resolved.items()}
+
+		# Pre-resolve each destination to an InputPeer so sends skip the session lookup
+		peers: Dict[int, Any] = {}
+		for dest_ids in resolved.values():
+			for dest_id in dest_ids:
+				if dest_id not in peers:
+					peers[dest_id] = await self._input_peer(dest_id)
+
+		# Peers missing from the cache (first start, new destination) are looked up in
+		# the dialogs once; their access hashes are then cached for later restarts.
+		unknown = [d for d, peer in peers.items() if peer is None]
+		if unknown:
+			self.log.info("Fetching dialogs to resolve destinations %s", unknown)
+			try:
+				await self.client.get_dialogs()
+			except Exception as e:
+				self.log.warning("Failed to fetch dialogs: %s", e)
+			for dest_id in unknown:
+				peers[dest_id] = await self._input_peer(dest_id)
+				if peers[dest_id] is None:
+					self.log.warning("Could not pre-resolve destination %s; will resolve on send", dest_id)
+					peers[dest_id] = dest_id
+
+		self.mappings = {src_id: tuple(peers[d] for d in dest_ids) for src_id, dest_ids in resolved.items()}
+		self._save_resolve_cache()
+
+
+# Entity types whose HTML tags don't depend on the entity's attributes
+_STATIC_TAGS: Dict[str, Tuple[str, str]] = {
+	"MessageEntityBold": ("<b>", "</b>"),
+	"MessageEntityItalic": ("<i>", "</i>"),
+	"MessageEntityCode": ("<code>", "</code>"),
+	"MessageEntityPre": ("<pre>", "</pre>"),
+	"MessageEntityUnderline": ("<u>", "</u>"),
+	"MessageEntityStrike": ("<s>", "</s>"),
+	"MessageEntitySpoiler": ("<tg-spoiler>", "</tg-spoiler>"),
+}
 
 
 def entities_to_html(text: str, entities) -> str:
@@ -204,73 +536,82 @@ def entities_to_html(text: str, entities) -> str:
 	if not entities:
 		return _html.escape(text)
 
-	inserts = []
+	# Entity offsets count UTF-16 code units; slice on the surrogate-expanded text so
+	# emoji and other astral characters before an entity don't shift it
+	text = helpers.add_surrogate(text)
+
+	# Tags are keyed by their position in the unescaped text; escaping happens later
+	# on the plain-text slices between positions, so offsets stay valid.
+	inserts_by_pos: Dict[int, List[str]] = {}
 	for ent in entities:
 		cls = ent.__class__.__name__
 		off = int(ent.offset)
 		ln = int(ent.length)
-		start_tag = ""
-		end_tag = ""
-
-		if cls == "MessageEntityBold":
-			start_tag, end_tag = "<b>", "</b>"
-		elif cls == "MessageEntityItalic":
-			start_tag, end_tag = "<i>", "</i>"
-		elif cls == "MessageEntityCode":
-			start_tag, end_tag = "<code>", "</code>"
-		elif cls == "MessageEntityPre":
-			start_tag, end_tag = "<pre>", "</pre>"
+		tags = _STATIC_TAGS.get(cls)
+		if tags is not None:
+			start_tag, end_tag = tags
 		elif cls == "MessageEntityTextUrl":
 			url = getattr(ent, "url", "")
 			start_tag = f"<a href=\"{_html.escape(url)}\">"
 			end_tag = "</a>"
 		elif cls == "MessageEntityUrl":
 			# URL entity: the text itself is the URL
-			start_tag = "<a href=\""
+			start_tag = f"<a href=\"{_html.escape(text[off:off + ln])}\">"
 			end_tag = "</a>"
 		elif cls in ("MessageEntityMentionName", "MessageEntityTextMention"):
 			user_id = getattr(ent, "user_id", None) or getattr(getattr(ent, "user", None), "id", None)
-			if user_id:
-				start_tag = f"<a href=\"tg://user?id={int(user_id)}\">"
-				end_tag = "</a>"
-		elif cls == "MessageEntityUnderline":
-			start_tag, end_tag = "<u>", "</u>"
-		elif cls == "MessageEntityStrike":
-			start_tag, end_tag = "<s>", "</s>"
-		elif cls == "MessageEntitySpoiler":
-			start_tag, end_tag = "<tg-spoiler>", "</tg-spoiler>"
+			if not user_id:
+				continue
+			start_tag = f"<a href=\"tg://user?id={int(user_id)}\">"
+			end_tag = "</a>"
 		else:
 			# Unsupported entity: skip formatting
 			continue
 
-		inserts.append((off, start_tag))
-		inserts.append((off + ln, end_tag))
-
-	# Escape text, then apply inserts by positions. Because escaping changes lengths,
-	# we apply tags to the unescaped text and finally escape parts without tags.
-	# Simpler approach: build final by walking original text and inserting tags.
-	inserts_by_pos = {}
-	for pos, tag in inserts:
-		inserts_by_pos.setdefault(pos, []).append(tag)
+		inserts_by_pos.setdefault(off, []).append(start_tag)
+		inserts_by_pos.setdefault(off + ln, []).append(end_tag)
 
+	# Walk tag boundaries in order, escaping the plain text between them in slices;
+	# the output list grows with the number of entities, not the text length
 	out = []
-	for i in range(len(text) + 1):
-		if i in inserts_by_pos:
-			# opening/closing tags: ensure opening tags appear before escaping
-			for tag in inserts_by_pos[i]:
-				out.append(tag)
-		if i < len(text):
-			out.append(_html.escape(text[i]))
-
-	return "".join(out)
+	prev = 0
+	for pos, tags in sorted(inserts_by_pos.items()):
+		if pos > prev:
+			out.append(_html.escape(text[prev:pos]))
+			prev = pos
+		out.extend(tags)
+	out.append(_html.escape(text[prev:]))
+
+	return helpers.del_surrogate("".join(out))
+
+
+def _peer_info(peer) -> Optional[Dict[str, Any]]:
+	"""Return the cacheable part of an InputPeer: its type and access hash."""
+	if isinstance(peer, InputPeerChannel):
+		return {"type": "channel", "access_hash": peer.access_hash}
+	if isinstance(peer, InputPeerUser):
+		return {"type": "user", "access_hash": peer.access_hash}
+	if isinstance(peer, InputPeerChat):
+		return {"type": "chat", "access_hash": None}
+	return None
+
+
+def _build_input_peer(peer_id: int, info: Dict[str, Any]):
+	"""Rebuild an InputPeer from a marked peer id and its cached info."""
+	real_id, _ = utils.resolve_id(peer_id)
+	if info["type"] == "channel":
+		return InputPeerChannel(real_id, info["access_hash"])
+	if info["type"] == "user":
+		return InputPeerUser(real_id, info["access_hash"])
+	return InputPeerChat(real_id)
 
 
 def load_config(path: str = "config.json") -> dict:
 	if not os.path.exists(path):
 		print(f"Config file not found: {path}")
 		sys.exit(1)
-	with open(path, "r", encoding="utf-8") as f:
-		cfg = json.load(f)
+	with open(path, "rb") as f:
+		cfg = orjson.loads(f.read())
 	return cfg
 
 
@@ -279,10 +620,11 @@ def normalize_id(value):
 	if isinstance(value, int):
 		return value
 	if isinstance(value, str):
-		if value.isdigit() or (value.startswith("-") and value[1:].isdigit()):
+		try:
 			return int(value)
-		# leave as username (str)
-		return value
+		except ValueError:
+			# leave as username (str)
+			return value
 	return value
 
 
@@ -301,11 +643,11 @@ if __name__ == "__main__":
 			dst = item.get("destination_id") or item.get("destination")
 			if src is None or dst is None:
 				continue
-			# allow destination to be a list or single value
+			# allow destination to be a list or single value; repeated sources are merged
 			if isinstance(dst, list):
-				raw_mappings[src] = dst
+				raw_mappings.setdefault(src, []).extend(dst)
 			else:
-				raw_mappings[src] = [dst]
+				raw_mappings.setdefault(src, []).append(dst)
 	else:
 		raw_sources = cfg.get("source_ids")
 		destination = cfg.get("destination_id")